@@ -1,3 +1,3 @@
 from .export_spike_labels import write_unit_labels_to_file
 from .export_spike_waveforms import write_to_tetrode_files
-from .assess_output import compare_spike_samples_between_recordings
+from .assess_output import compare_spike_samples_between_recordings, compare_spike_samples_between_files
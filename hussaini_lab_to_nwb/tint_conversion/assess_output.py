@@ -1,9 +1,13 @@
+import warnings
+from pathlib import Path
+
 import pandas as pd
 import numpy as np
-from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
 
 
-def compare_spike_samples_between_recordings(rec1, rec2, sorting=None):
+def compare_spike_samples_between_recordings(rec1, rec2, sorting=None, max_workers=None):
     ''' Given two AxonaUnitRecordingExtractor objects, one based on .X files
     created from the raw recording using a thresholding method, and one created
     from the .X files using a spike sorting algorithm, compute comparison metrics
@@ -17,6 +21,9 @@ def compare_spike_samples_between_recordings(rec1, rec2, sorting=None):
     sorting : SortingExtractor or None, default=None (optional)
         The sorting extractor used for the tint conversion. When not provided
         there is no information about how many units were deteced per tetrode.
+    max_workers : int or None, default=None (optional)
+        Number of tetrodes compared in parallel. Defaults to the number of
+        tetrodes, capped at 8.
 
     Returns
     -------
@@ -26,117 +33,345 @@ def compare_spike_samples_between_recordings(rec1, rec2, sorting=None):
         'No spikes found in at least one specified recording extractor. Maybe there are no `.X` files?'
 
     channel_groups = np.unique(rec1.get_channel_groups())
+    num_units_per_group = get_num_units_per_group(sorting, int(channel_groups.max()) + 1)
+
+    if max_workers is None:
+        max_workers = min(8, len(channel_groups))
+
+    def compare_group(group_id):
+        return compare_group_spike_samples(rec1, rec2, group_id, num_units_per_group[group_id])
+
+    # reading timestamps and the (GIL-releasing) pairing kernel run concurrently across tetrodes
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        rows = list(executor.map(compare_group, channel_groups))
+
+    df = pd.DataFrame(rows)
+
+    return df
+
+
+def compare_spike_samples_between_files(filename_old, filename_new, sorting=None, max_workers=None):
+    ''' Same as `compare_spike_samples_between_recordings`, but spike timestamps
+    are read directly from the `.X` files sharing the basename of the given
+    `.set` files. Only the timestamps are read, waveforms are skipped.
+
+    Parameters
+    ----------
+    filename_old, filename_new : str or Path
+        Old and new full filenames of pre- and post- conversion `.set` files.
+    sorting : SortingExtractor or None, default=None (optional)
+        The sorting extractor used for the tint conversion. When not provided
+        there is no information about how many units were deteced per tetrode.
+    max_workers : int or None, default=None (optional)
+        Number of tetrodes compared in parallel. Defaults to the number of
+        tetrodes, capped at 8.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+    '''
+    old_tetrode_files = get_tetrode_files(filename_old)
+    new_tetrode_files = get_tetrode_files(filename_new)
+    tetrode_ids = sorted(set(old_tetrode_files) & set(new_tetrode_files))
+
+    unmatched_ids = sorted(set(old_tetrode_files) ^ set(new_tetrode_files))
+    if unmatched_ids:
+        warnings.warn('Tetrodes {} only exist for one of the two recordings and are not compared'.format(
+            unmatched_ids))
+
+    assert len(tetrode_ids) > 0, \
+        'No spikes found in at least one specified recording. Maybe there are no `.X` files?'
+
+    # tetrodes are 1-indexed, groups are 0-indexed
+    num_units_per_group = get_num_units_per_group(sorting, tetrode_ids[-1])
 
+    if max_workers is None:
+        max_workers = min(8, len(tetrode_ids))
+
+    def compare_tetrode(tetrode_id):
+        old_timestamps = read_tetrode_timestamps(old_tetrode_files[tetrode_id])
+        new_timestamps = read_tetrode_timestamps(new_tetrode_files[tetrode_id])
+        return compare_group_timestamps(
+            old_timestamps, new_timestamps, tetrode_id - 1, num_units_per_group[tetrode_id - 1]
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        rows = list(executor.map(compare_tetrode, tetrode_ids))
+
+    df = pd.DataFrame(rows)
+
+    return df
+
+
+def get_num_units_per_group(sorting, num_groups):
+    ''' Number of units per group id, or np.nan for each group if `sorting`
+    is None.
+
+    Parameters
+    ----------
+    sorting : SortingExtractor or None
+    num_groups : int
+
+    Returns
+    -------
+    num_units_per_group : np.array
+        Indexed by group id.
+    '''
     if sorting:
-        unit_group_ids = sorting.get_units_property(property_name='group')
-        num_units_per_group = Counter(unit_group_ids)
+        unit_group_ids = np.asarray(sorting.get_units_property(property_name='group'), dtype=np.int64)
+        return np.bincount(unit_group_ids, minlength=num_groups)
     else:
-        num_units_per_group = [np.nan] * len(channel_groups)
+        return np.full(num_groups, np.nan)
 
-    for i, group_id in enumerate(channel_groups):
 
-        # Note: `spike_channel_index` is actually the group id (i.e. tetrode id - 1)
-        # Note: Spiketimes are sampled at twice the signal's frequency
-        old_timestamps = deque(rec1.neo_reader.get_spike_timestamps(spike_channel_index=group_id) // 2)
-        new_timestamps = deque(rec2.neo_reader.get_spike_timestamps(spike_channel_index=group_id) // 2)
+def get_tetrode_files(filename):
+    ''' Find the `.X` files sharing the basename of `filename`.
 
-        num_spikes_old = len(old_timestamps)
-        num_spikes_new = len(new_timestamps)
+    Parameters
+    ----------
+    filename : str or Path
+        Full filename of .set file or base-filename.
 
-        paired_spikes, noise_spikes = compare_spike_samples(old_timestamps, new_timestamps)
+    Returns
+    -------
+    tetrode_files : dict
+        Maps tetrode id (1-indexed) to its `.X` file.
+    '''
+    filename = Path(filename)
+    if filename.suffix == '.set':
+        filename = filename.with_suffix('')
 
-        metrics = compute_timestamp_comparison_metrics(paired_spikes)
-        metrics['group_id'] = int(group_id)
-        metrics['num_units'] = int(num_units_per_group[group_id])
-        metrics['num_spikes_thresh'] = int(num_spikes_old)
-        metrics['num_spikes_sort'] = int(num_spikes_new)
-        metrics['num_spikes_in_noise'] = int(noise_spikes)
+    tetrode_files = {}
+    for tetrode_file in filename.parent.iterdir():
+        stem, _, tetrode_id = tetrode_file.name.rpartition('.')
+        if (stem == filename.name) and tetrode_id.isdigit() and tetrode_file.is_file():
+            tetrode_files[int(tetrode_id)] = tetrode_file
 
-        if i == 0:
-            df = pd.DataFrame(metrics)
-        else:
-            df = df.append(pd.DataFrame(metrics), ignore_index=True)
+    return tetrode_files
 
-    return df
 
+def read_tetrode_timestamps(tetrode_file):
+    ''' Read spike timestamps from a `.X` file, converted to samples of the
+    recording (i.e. divided by `timebase / sample_rate`). Waveform bytes are
+    skipped.
+
+    Parameters
+    ----------
+    tetrode_file : str or Path
 
-def compare_spike_samples(threshold_timestamps, sorting_timestamps):
+    Returns
+    -------
+    timestamps : np.array
+        (n_spikes,) int64 spike samples
+    '''
+    with open(tetrode_file, 'rb') as f:
+
+        # header is ASCII, read in blocks until `data_start`
+        blob = b''
+        while b'data_start' not in blob:
+            block = f.read(1 << 16)
+            if not block:
+                raise ValueError('No `data_start` found in {}'.format(tetrode_file))
+            blob += block
+        data_offset = blob.index(b'data_start') + len(b'data_start')
+
+        header = {}
+        for line in blob[:data_offset].decode('cp1252').splitlines():
+            key, _, value = line.partition(' ')
+            header[key] = value.strip()
+
+        num_chans = int(header['num_chans'])
+        bytes_per_timestamp = int(header['bytes_per_timestamp'])
+        bytes_per_spike = num_chans * (
+            bytes_per_timestamp + int(header['samples_per_spike']) * int(header['bytes_per_sample'])
+        )
+        # only the first channel's timestamp of each spike is read
+        spike_dtype = np.dtype([
+            ('timestamp', '>i{}'.format(bytes_per_timestamp)),
+            ('samples', 'V{}'.format(bytes_per_spike - bytes_per_timestamp))
+        ])
+
+        f.seek(data_offset)
+        spikes = np.fromfile(f, dtype=spike_dtype, count=int(header['num_spikes']))
+
+    timebase = float(header['timebase'].split()[0])
+    sample_rate = float(header['sample_rate'].split()[0])
+
+    return spikes['timestamp'].astype(np.int64) // int(round(timebase / sample_rate))
+
+
+def compare_group_spike_samples(rec1, rec2, group_id, num_units):
+    ''' Compute comparison metrics of how well spike times of a single tetrode
+    correspond between two AxonaUnitRecordingExtractor objects (see
+    `compare_spike_samples_between_recordings`).
+
+    Parameters
+    ----------
+    rec1, rec2 : AxonaUnitRecordingExtractor
+    group_id : int
+        Tetrode to compare, 0-indexed (i.e. tetrodeID - 1)
+    num_units : int or float
+        Number of units detected on this tetrode by the spike sorter, or
+        np.nan if unknown.
+
+    Returns
+    -------
+    metrics : dict
+    '''
+    # Note: `spike_channel_index` is actually the group id (i.e. tetrode id - 1)
+    # Note: Spiketimes are sampled at twice the signal's frequency
+    # Note: Cast to signed ints so that timestamp differences can be negative
+    old_timestamps = rec1.neo_reader.get_spike_timestamps(spike_channel_index=group_id).astype(np.int64) // 2
+    new_timestamps = rec2.neo_reader.get_spike_timestamps(spike_channel_index=group_id).astype(np.int64) // 2
+
+    return compare_group_timestamps(old_timestamps, new_timestamps, group_id, num_units)
+
+
+def compare_group_timestamps(old_timestamps, new_timestamps, group_id, num_units):
+    ''' Compute comparison metrics of how well spike samples of a single tetrode
+    correspond between the original and the converted `.X` file.
+
+    Parameters
+    ----------
+    old_timestamps, new_timestamps : np.array
+        Sorted spike samples (int64) of the original and the converted file.
+    group_id : int
+        Tetrode to compare, 0-indexed (i.e. tetrodeID - 1)
+    num_units : int or float
+        Number of units detected on this tetrode by the spike sorter, or
+        np.nan if unknown.
+
+    Returns
+    -------
+    metrics : dict
+    '''
+    num_spikes_old = len(old_timestamps)
+    num_spikes_new = len(new_timestamps)
+
+    time_diffs, num_paired, noise_spikes = compare_spike_samples(old_timestamps, new_timestamps)
+
+    metrics = compute_timestamp_comparison_metrics(time_diffs, num_paired)
+    metrics['group_id'] = int(group_id)
+    metrics['num_units'] = num_units if np.isnan(num_units) else int(num_units)
+    metrics['num_spikes_thresh'] = int(num_spikes_old)
+    metrics['num_spikes_sort'] = int(num_spikes_new)
+    metrics['num_spikes_in_noise'] = int(noise_spikes)
+
+    return metrics
+
+
+def compare_spike_samples(threshold_timestamps, sorting_timestamps, window=50):
     ''' Compare overlap between timestamps from original TINT conversion (using only
     a threshold to find spike-times) and timestamps from spike sorting.
 
+    Each sorting timestamp is paired with the first threshold timestamp it lies
+    within `window` samples of. Sorting timestamps that are not paired with any
+    threshold timestamp are counted as noise.
+
     Parameters
     ----------
-    threshold_timestamps, sorting_timestamps : deque
+    threshold_timestamps, sorting_timestamps : np.array
+        Sorted spike samples.
+    window : int, default=50
+        Maximum distance (in samples) between a threshold and a sorting timestamp
+        for them to be paired.
 
     Returns
     -------
-    paired_spikes : dict
-        Keys are threshold timestamps. Values are lists of tuples of sorting timestamps and the
-        timestamp difference between each sorting timestamps and threshold timestamp.
+    time_diffs : np.array
+        Timestamp difference between each paired sorting timestamp and its threshold
+        timestamp, ordered by threshold timestamp.
+    num_paired : np.array
+        Number of sorting timestamps paired with each threshold timestamp.
     noise_spikes : int
         Number of sorting timestamps identified in the noise.
     '''
-    paired_spikes = {}
-    noise_spikes = 0
-    get_new = True
+    threshold_timestamps = np.asarray(threshold_timestamps, dtype=np.int64)
+    sorting_timestamps = np.asarray(sorting_timestamps, dtype=np.int64)
+
+    pair_starts, num_paired, noise_spikes = _pair_spikes(threshold_timestamps, sorting_timestamps, window)
+
+    # Paired sorting timestamps form contiguous, ordered runs starting at `pair_starts`
+    run_offsets = np.cumsum(num_paired) - num_paired
+    paired_idxs = np.arange(num_paired.sum()) + np.repeat(pair_starts - run_offsets, num_paired)
 
-    while sorting_timestamps and threshold_timestamps:
+    time_diffs = sorting_timestamps[paired_idxs] - np.repeat(threshold_timestamps, num_paired)
 
-        old_ts = threshold_timestamps.popleft()
-        if get_new:
-            new_ts = sorting_timestamps.popleft()
-            get_new = False
-        t_diff = new_ts - old_ts
+    return time_diffs, num_paired, int(noise_spikes)
 
-        while t_diff < -50 and sorting_timestamps:
-            new_ts = sorting_timestamps.popleft()
-            t_diff = new_ts - old_ts
-            noise_spikes += 1
 
-        new_spikes = []
-        while (abs(t_diff) <= 50) and (sorting_timestamps):
-            new_spikes.append((new_ts, t_diff))
-            new_ts = sorting_timestamps.popleft()
-            t_diff = new_ts - old_ts
+@njit(cache=True, nogil=True)
+def _pair_spikes(threshold_timestamps, sorting_timestamps, window):
+    ''' Two-pointer pass over sorted threshold and sorting timestamps.
 
-        paired_spikes[old_ts] = new_spikes
+    Returns
+    -------
+    pair_starts : np.array
+        Index of the first sorting timestamp paired with each threshold timestamp.
+    pair_counts : np.array
+        Number of sorting timestamps paired with each threshold timestamp.
+    noise_count : int
+        Number of sorting timestamps skipped because they are not within
+        `window` samples of any threshold timestamp.
+    '''
+    n_thresh = threshold_timestamps.shape[0]
+    n_sort = sorting_timestamps.shape[0]
+    pair_starts = np.zeros(n_thresh, dtype=np.int64)
+    pair_counts = np.zeros(n_thresh, dtype=np.int64)
+    noise_count = 0
 
-    return paired_spikes, noise_spikes
+    j = 0
+    for i in range(n_thresh):
+        ts = threshold_timestamps[i]
+        while j < n_sort and sorting_timestamps[j] < ts - window:
+            noise_count += 1
+            j += 1
+        pair_starts[i] = j
+        while j < n_sort and sorting_timestamps[j] <= ts + window:
+            j += 1
+        pair_counts[i] = j - pair_starts[i]
 
+    # sorting timestamps after the last threshold window are noise, too
+    noise_count += n_sort - j
 
-def compute_timestamp_comparison_metrics(paired_spikes):
-    ''' Given a dictionary from `compare_thresholding_vs_sorting_spike_samples`,
-    compute descriptive metrics to evaluate correspondence of the two timestamp series
-    and return them in a pandas.DataFrame.
+    return pair_starts, pair_counts, noise_count
+
+
+def compute_timestamp_comparison_metrics(time_diffs, num_paired):
+    ''' Given the output of `compare_spike_samples`, compute descriptive metrics
+    to evaluate correspondence of the two timestamp series.
 
     Parameters
     ----------
-    paired_spikes : dict
-        Keys are threshold timestamps. Values are lists of tuples of sorting timestamps and the
-        timestamp difference between each sorting timestamps and threshold timestamp.
+    time_diffs : np.array
+        Timestamp difference between each paired sorting timestamp and its threshold
+        timestamp, ordered by threshold timestamp.
+    num_paired : np.array
+        Number of sorting timestamps paired with each threshold timestamp.
 
     Returns
     -------
     dict
     '''
-    multiple_spikes = 0
-    missing_spikes = 0
-    non_overlap, abs_non_overlap = [], []
-    for k, v in paired_spikes.items():
-        if not v:
-            missing_spikes += 1
-        if len(v) > 1:
-            multiple_spikes += 1
-        if len(v) >= 1:
-            non_overlap.append(sum([el[1] for el in v]))
-            abs_non_overlap.append(sum([abs(el[1]) for el in v]))
-
-    stderr_non_overlap = np.std(non_overlap) / np.sqrt(len(non_overlap))
-    mean_non_overlap = sum(abs_non_overlap) / len(non_overlap)
+    num_paired = np.asarray(num_paired)
+    found = num_paired > 0
+    num_found = int(found.sum())
+    multiple_spikes = int((num_paired > 1).sum())
+
+    if num_found > 0:
+        # Summed (absolute) timestamp differences per threshold timestamp with at least one pair
+        starts = (np.cumsum(num_paired) - num_paired)[found]
+        non_overlap = np.add.reduceat(time_diffs, starts)
+        abs_non_overlap = np.add.reduceat(np.abs(time_diffs), starts)
+
+        stderr_non_overlap = non_overlap.std() / np.sqrt(num_found)
+        mean_non_overlap = abs_non_overlap.sum() / num_found
+    else:
+        stderr_non_overlap = mean_non_overlap = np.nan
 
     return {
-        'num_signal_snippets_found_by_sorter': [int(len(non_overlap))],
-        'num_signal_snippets_with_multiple_spikes': [int(multiple_spikes)],
-        'mean_non_overlapping_samples': [mean_non_overlap],
-        'stderr_non_overlapping_samples': [stderr_non_overlap]
+        'num_signal_snippets_found_by_sorter': num_found,
+        'num_signal_snippets_with_multiple_spikes': multiple_spikes,
+        'mean_non_overlapping_samples': mean_non_overlap,
+        'stderr_non_overlapping_samples': stderr_non_overlap
     }
@@ -26,15 +26,12 @@ def convert_spike_train_to_label_array(spike_train):
     '''
 
     # Generate Index array (indexing the unit for a given spike sample)
-    unit_labels = []
-    for i, l in enumerate(spike_train):
-        unit_labels.append(np.ones((len(l),), dtype=int) * i)
+    lengths = [len(l) for l in spike_train]
+    unit_labels_flat = np.repeat(np.arange(len(spike_train)), lengths)
+    spike_train_flat = np.concatenate(spike_train)
 
-    # Flatten lists and sort them
-    spike_train_flat = np.concatenate(spike_train).ravel()
-    unit_labels_flat = np.concatenate(unit_labels).ravel()
-
-    sort_index = np.argsort(spike_train_flat)
+    # Each unit's spike train is already sorted, which a stable sort (timsort / radix) exploits
+    sort_index = np.argsort(spike_train_flat, kind='stable')
 
     unit_labels_sorted = unit_labels_flat[sort_index]
 
@@ -66,9 +63,9 @@ def write_to_cut_file(cut_filename, unit_labels):
     https://github.com/GeoffBarrett/gebaSpike
     '''
     basename = os.path.basename(os.path.splitext(cut_filename)[0])
-    unique_cells = np.unique(unit_labels)
 
-    n_clusters = len(np.unique(unit_labels))
+    # labels are small non-negative ints, so counting them avoids sorting
+    n_clusters = np.count_nonzero(np.bincount(unit_labels))
     n_spikes = len(unit_labels)
 
     write_list = []
@@ -89,13 +86,18 @@ def write_to_cut_file(cut_filename, unit_labels):
         write_list.append('{}max:{}'.format(spaces, zero_line))
     write_list.append('\nExact_cut_for: {} spikes: {}\n'.format(basename, n_spikes))
 
-    # 25 unit labels per row
-    n_rows = int(np.floor(n_spikes / 25))
-    remaining = int(n_spikes - n_rows * 25)
+    # 25 unit labels per row, formatted in chunks of rows to avoid one
+    # format string and tuple as large as the whole file
+    unit_labels = np.asarray(unit_labels).tolist()
+    chunk_size = 25 * 4096
+    for start in range(0, n_spikes, chunk_size):
+        chunk = unit_labels[start:start + chunk_size]
+        n_rows = len(chunk) // 25
+        remaining = len(chunk) - n_rows * 25
 
-    cut_string = ('%3u' * 25 + '\n') * n_rows + '%3u' * remaining
+        cut_string = ('%3u' * 25 + '\n') * n_rows + '%3u' * remaining
 
-    write_list.append(cut_string % (tuple(unit_labels)))
+        write_list.append(cut_string % tuple(chunk))
 
     with open(cut_filename, 'w') as f:
         f.writelines(write_list)
@@ -123,10 +125,14 @@ def write_to_clu_file(clu_filename, unit_labels):
     unit_labels = np.asarray(unit_labels).astype(int)
     unit_labels += 1
 
-    n_clu = len(np.unique(unit_labels))
+    n_clu = np.count_nonzero(np.bincount(unit_labels))
     unit_labels = np.concatenate(([n_clu], unit_labels))
 
-    np.savetxt(clu_filename, unit_labels, fmt='%d', delimiter='\n')
+    # One value per line, formatted in bulk and written at once
+    clu_string = '\n'.join(unit_labels.astype(str).tolist()) + '\n'
+
+    with open(clu_filename, 'wb') as f:
+        f.write(clu_string.encode('ascii'))
 
 
 def set_cut_filename_from_basename(filename, tetrode_id):
@@ -162,11 +168,16 @@ def write_unit_labels_to_file(sorting_extractor, filename):
 
     unit_ids = np.array(sorting_extractor.get_unit_ids())
 
-    for i in np.unique(tetrode_ids):
+    # partition units by tetrode in one pass: units of a tetrode are contiguous in `order`
+    order = np.argsort(tetrode_ids, kind='stable')
+    unique_tetrode_ids, starts = np.unique(tetrode_ids[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+
+    for i, start, end in zip(unique_tetrode_ids, starts, ends):
 
         print('Write unit labels for tetrode {} to .cut and .clu'.format(i))
 
-        spike_train = sorting_extractor.get_units_spike_train(unit_ids=unit_ids[tetrode_ids == i])
+        spike_train = sorting_extractor.get_units_spike_train(unit_ids=unit_ids[order[start:end]])
         unit_labels = convert_spike_train_to_label_array(spike_train)
 
         # We use Axona conventions for filenames (tetrodes are 1 indexed)
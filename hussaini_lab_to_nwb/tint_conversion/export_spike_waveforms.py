@@ -1,12 +1,30 @@
 import os
-import struct
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
-import spiketoolkit as st
+import spikeextractors as se
 
 from .utils import get_group_property_name, assert_group_names_match
 
+# One record per spike and channel: big-endian timestamp followed by 50 int8 samples
+# (`spike_format t,ch1,t,ch2,t,ch3,t,ch4` with 4 bytes per timestamp and 1 byte per sample)
+TETRODE_RECORD_DTYPE = np.dtype([('timestamp', '>i4'), ('waveform', 'i1', (50,))])
+
+# Tetrode file header following the .set file header. We are enforcing the
+# defaults from the file format manual, only the sample rate and spike count vary.
+TETRODE_HEADER_TEMPLATE = (
+    'num_chans 4\n'
+    'timebase 96000 hz\n'
+    'bytes_per_timestamp 4\n'
+    'samples_per_spike 50\n'
+    'sample_rate {Fs} hz\n'
+    'bytes_per_sample 1\n'
+    'spike_format t,ch1,t,ch2,t,ch3,t,ch4\n'
+    'num_spikes {n_spikes}\n'
+    'data_start'
+)
+
 
 def parse_generic_header(filename):
     """
@@ -19,16 +37,21 @@ def parse_generic_header(filename):
     filename : str or Path
         Full filename.
     """
-    header = {}
+    blob = b''
     with open(filename, 'rb') as f:
-        for bin_line in f:
-            if b'data_start' in bin_line:
+        # read in blocks up to `data_start`, which is followed by binary data
+        while b'data_start' not in blob:
+            block = f.read(1 << 16)
+            if not block:
                 break
-            line = bin_line.decode('cp1252').replace('\r\n', '').replace('\r', '').strip()
-            parts = line.split(' ')
-            key = parts[0]
-            value = ' '.join(parts[1:])
-            header[key] = value
+            blob += block
+
+    header = {}
+    for line in blob.split(b'data_start', 1)[0].decode('cp1252').splitlines():
+        parts = line.strip().split(' ')
+        key = parts[0]
+        value = ' '.join(parts[1:])
+        header[key] = value
 
     return header
 
@@ -47,14 +70,22 @@ def get_set_header(set_file):
     Largely based on gebaSpike implementation by Geoff Barrett
     https://github.com/GeoffBarrett/gebaSpike
     """
-    header = ''
-    with open(set_file, 'r+') as f:
-        for line in f:
-            header += line
-            if 'sw_version' in line:
+    blob = b''
+    with open(set_file, 'rb') as f:
+        # read in blocks until the end of the `sw_version` line
+        while True:
+            block = f.read(4096)
+            blob += block
+            idx = blob.find(b'sw_version')
+            if not block or (idx >= 0 and blob.find(b'\n', idx) >= 0):
                 break
 
-    return header
+    if idx >= 0:
+        end = blob.find(b'\n', idx)
+        blob = blob if end < 0 else blob[:end + 1]
+
+    # Line endings are normalized as in text mode
+    return blob.decode('cp1252').replace('\r\n', '\n')
 
 
 def get_unit_group_ids(sorting):
@@ -66,183 +97,246 @@ def get_unit_group_ids(sorting):
 
     Returns
     -------
-    group_ids : List
-        List of groups ids for each Unit in `sorting`.
+    group_ids : np.array
+        Groups ids (int64) for each Unit in `sorting`.
     '''
     group_property_name = get_group_property_name(sorting)
+    group_ids = sorting.get_units_property(property_name=group_property_name)
 
-    unit_ids = sorting.get_unit_ids()
-    group_ids = [sorting.get_unit_property(
-        unit_id=unit_id, property_name=group_property_name) for unit_id in unit_ids
-    ]
-
-    return [int(group_id) for group_id in group_ids]
+    return np.asarray(group_ids, dtype=np.int64)
 
 
-def combine_units_on_tetrode(group_spike_samples, group_waveforms):
-    '''Write all waveforms of given tetrode in dictionary with the
-    corresponding spike samples being the keys (1 sample for each
-    waveform).
+def get_channel_group_index(recording, group_property_name='group'):
+    '''Get channel ids ordered by group, so that the channels of each group
+    are a contiguous slice.
 
     Parameters
     ----------
-    group_spike_samples : list
-        As returned by sortingextractor.get_units_spike_train()
-    group_waveforms : list
-        As returned by spiketoolkit.postprocessing.get_unit_waveforms()
+    recording : RecordingExtractor
+    group_property_name : str, default='group' (optional)
+        Channel property that assigns channels to tetrodes.
 
     Returns
     -------
-    tetrode_spikes : dict
-        Keys are spike samples, values are waveforms (ntrls x nch x nsamp)
+    channel_group_ids : np.array
+        Unique group ids (int64), ascending.
+    offsets : np.array
+        (n_groups + 1,) start of each group in `sorted_channel_ids`, the
+        channels of group `channel_group_ids[k]` are
+        `sorted_channel_ids[offsets[k]:offsets[k + 1]]`.
+    sorted_channel_ids : np.array
+        Channel ids ordered by group (original order within a group).
     '''
-    tetrode_spikes = {}
+    channel_ids = np.asarray(recording.get_channel_ids())
+    if group_property_name == 'group':
+        channel_groups = np.asarray(recording.get_channel_groups(channel_ids=channel_ids.tolist()), dtype=np.int64)
+    else:
+        channel_groups = np.asarray([
+            recording.get_channel_property(channel_id=channel_id, property_name=group_property_name)
+            for channel_id in channel_ids
+        ], dtype=np.int64)
 
-    for i, (samples, waveforms) in enumerate(zip(group_spike_samples, group_waveforms)):
+    order = np.argsort(channel_groups, kind='stable')
+    channel_group_ids, starts = np.unique(channel_groups[order], return_index=True)
+    offsets = np.append(starts, len(order))
 
-        for sample, waveform in zip(samples, waveforms):
+    return channel_group_ids, offsets, channel_ids[order]
 
-            tetrode_spikes[sample] = waveform
 
-    return tetrode_spikes
+def combine_units_on_tetrode(group_spike_samples):
+    '''Combine spike samples of all units on a given tetrode and order them.
 
+    Parameters
+    ----------
+    group_spike_samples : list
+        As returned by sortingextractor.get_units_spike_train()
 
-def get_waveforms(recording, sorting, unit_ids, header):
+    Returns
+    -------
+    spike_samples : np.array
+        Spike samples of all units (n_spikes,), in ascending order
+    '''
+    # Each unit's spike train is already sorted, which a stable sort exploits
+    return np.sort(np.concatenate(group_spike_samples).astype(np.int64), kind='stable')
+
+
+def get_waveforms(recording, channel_ids, spike_samples, header, chunk_size=2**20):
     '''Get waveforms for specific tetrode.
 
+    Snippets are cut out of the raw traces with a single fancy-indexing
+    operation per chunk of the recording. Samples outside of the recording
+    are set to 0.
+
     Parameters
     ----------
     recording : RecordingExtractor
-    sorting : SortingExtractor
-    unit_ids : List
-        List of unit ids to extract waveforms
+    channel_ids : List
+        Channel ids of the tetrode
+    spike_samples : np.array
+        Spike samples (n_spikes,) in ascending order
     header : dict
         maps parameters from .set file to their values (as strings).
+    chunk_size : int, default=2**20 (optional)
+        Number of frames of the recording read at once.
 
     Returns
     -------
-    waveforms : List
-        List of np.array (n_spikes, n_channels, n_timepoints) with waveforms for each unit
+    waveforms : np.array
+        (n_spikes, n_channels, n_timepoints) int8 waveforms
     '''
-    sampling_rate = recording.get_sampling_frequency()
     samples_before = int(header['pretrigSamps'])
     samples_after = int(header['spikeLockout'])
+    offsets = np.arange(-samples_before, samples_after)
 
-    ms_before = samples_before / (sampling_rate / 1000) + 0.001
-    ms_after = samples_after / (sampling_rate / 1000) + 0.001
+    spike_samples = np.asarray(spike_samples, dtype=np.int64)
+    num_frames = recording.get_num_frames()
+    waveforms = np.zeros((len(spike_samples), len(channel_ids), len(offsets)), dtype=np.int8)
 
-    group_property_name = get_group_property_name(sorting)
+    # spike samples are sorted, so each chunk serves a contiguous block of spikes
+    chunk_starts = np.arange(0, num_frames, chunk_size)
+    spike_bounds = np.searchsorted(spike_samples, np.append(chunk_starts, num_frames))
 
-    waveforms = st.postprocessing.get_unit_waveforms(
-        recording,
-        sorting,
-        unit_ids=unit_ids,
-        max_spikes_per_unit=None,
-        grouping_property=group_property_name,
-        recompute_info=True,
-        ms_before=ms_before,
-        ms_after=ms_after,
-        return_idxs=False,
-        return_scaled=False,
-        dtype=np.int8
-    )
+    for first_spike, last_spike in zip(spike_bounds[:-1], spike_bounds[1:]):
+        if first_spike == last_spike:
+            continue
+
+        chunk_samples = spike_samples[first_spike:last_spike]
+        start_frame = max(int(chunk_samples[0]) - samples_before, 0)
+        end_frame = min(int(chunk_samples[-1]) + samples_after, num_frames)
+        traces = recording.get_traces(
+            channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame, return_scaled=False
+        )
+
+        # (n_spikes, n_timepoints) indices into the traces of this chunk
+        idxs = chunk_samples[:, None] + offsets[None, :] - start_frame
+        outside = (idxs < 0) | (idxs >= traces.shape[1])
+        snippets = traces[:, np.clip(idxs, 0, traces.shape[1] - 1)]
+        snippets[:, outside] = 0
+
+        waveforms[first_spike:last_spike] = snippets.transpose(1, 0, 2)
 
     return waveforms
 
 
-def write_tetrode_file_header(tetrode_file, n_spikes_chan, Fs):
+def write_tetrode_file_header(f, n_spikes_chan, Fs, set_header):
     ''' Generate and write header of tetrode file
 
     Parameters
     ----------
-    tetrode_file : str or Path
-        Full filename to write to
+    f : file object
+        Tetrode file opened for binary writing
     n_spikes_chan : int
         Number of spikes to write to file
     Fs : int
         Sampling frequency of data
+    set_header : str
+        First lines of the .set file, as returned by `get_set_header`
     '''
-    path = Path(tetrode_file).parent
-    filename = Path(tetrode_file).name
-    basename = filename.split('.')[0]
-    set_file = path / '{}.set'.format(basename)
-
-    # We are enforcing the defaults from the file format manual
-    header = get_set_header(set_file)
-    to_write = [
-        header,
-        'num_chans 4\n',
-        'timebase {} hz\n'.format(96000),
-        'bytes_per_timestamp {}\n'.format(4),
-        'samples_per_spike {}\n'.format(50),
-        'sample_rate {} hz\n'.format(Fs),
-        'bytes_per_sample {}\n'.format(1),
-        'spike_format t,ch1,t,ch2,t,ch3,t,ch4\n',
-        'num_spikes {}\n'.format(n_spikes_chan),
-        'data_start'
-    ]
-
-    with open(tetrode_file, 'w') as f:
-        f.writelines(to_write)
-
-
-def write_tetrode_file_data(tetrode_file, waveform_dict, Fs):
+
+    header = set_header + TETRODE_HEADER_TEMPLATE.format(Fs=Fs, n_spikes=n_spikes_chan)
+
+    f.write(header.encode('cp1252'))
+
+
+def write_tetrode_file_data(f, spike_samples, waveforms, Fs):
     ''' Write binary data to tetrode file
 
     Parameters
     ----------
-    tetrode_file : str or Path
-        Full filename of tetrode file to write to
-    waveform_dict : dict
-        Keys are spike timestamps, values are corresponding waveforms (np.memmap).
-        Timestamps are int64, waveforms are int8
+    f : file object
+        Tetrode file opened for binary writing, positioned after the header
+    spike_samples : np.array
+        Spike samples (n_spikes,) in ascending order, int64
+    waveforms : np.array
+        Corresponding waveforms (n_spikes x 4 x 50), int8
     Fs : int
         Sampling frequency of data
     '''
 
-    # create ordered spike times and waveforms from input dict
-    spike_times = np.asarray(sorted(waveform_dict.keys()))
-    spike_times = np.tile(spike_times, (4, 1))
-    spike_times = spike_times.flatten(order='F')
+    # re-adjust spike times to reflect 96000 hz sampling rate, in int64 so
+    # that neither the caller's array is modified nor int32 input overflows
+    spike_times = np.asarray(spike_samples).astype(np.int64) * (96000 // int(Fs))
+    if len(spike_times) and spike_times.max() > np.iinfo(np.int32).max:
+        raise ValueError('Spike times exceed the int32 range of .X timestamps (96 kHz timebase), '
+                         'the recording is too long for a single .X file')
+
+    # repeat each spike time for the 4 channels
+    spike_times = np.repeat(spike_times, 4)
 
     n_spikes = spike_times.shape[0]
-    spike_values = np.asarray([value for (key, value) in sorted(waveform_dict.items())])
-    spike_values = spike_values.reshape((n_spikes, 50))
+    spike_values = waveforms.reshape((n_spikes, 50))
 
-    # re-adjust spike_times to reflect 96000 hz sampling rate
-    spike_times *= 96000 // int(Fs)
+    # combine timestamps and waveforms
+    spike_records = np.empty(n_spikes, dtype=TETRODE_RECORD_DTYPE)
+    spike_records['timestamp'] = spike_times
+    spike_records['waveform'] = spike_values
 
-    t_packed = struct.pack('>%di' % n_spikes, *spike_times)
-    spike_data_pack = struct.pack('<%db' % (n_spikes * 50), *spike_values.flatten())
+    f.write(spike_records)
+    f.write(bytes('\r\ndata_end\r\n', 'utf-8'))
 
-    # combine timestamps (4 bytes per sample) and waveforms (1 byte per sample)
-    comb_list = [None] * (2 * n_spikes)
-    comb_list[::2] = [t_packed[i:i + 4] for i in range(0, len(t_packed), 4)]
-    comb_list[1::2] = [spike_data_pack[i:i + 50] for i in range(0, len(spike_data_pack), 50)]
 
-    with open(tetrode_file, 'ab') as f:
-        f.writelines(comb_list)
-        f.writelines([bytes('\r\ndata_end\r\n', 'utf-8')])
+def write_tetrode(tetrode_file, spike_samples, waveforms, Fs, set_header=None):
+    ''' Write data to tetrode (`.X`) file
 
+    Parameters
+    ----------
+    tetrode_file : str or Path
+        Full filename of tetrode file to write to
+    spike_samples : np.array
+        Spike samples (n_spikes,) in ascending order, int64
+    waveforms : np.array
+        Corresponding waveforms (n_spikes x 4 x 50), int8
+    Fs : int
+        Sampling frequency of data
+    set_header : str or None, default=None (optional)
+        First lines of the .set file, as returned by `get_set_header`. If None,
+        it is read from the .set file with the same base filename as
+        `tetrode_file`. Pass it in when writing several tetrodes to avoid
+        reading the .set file for each of them.
+    '''
+    if set_header is None:
+        set_file = Path(tetrode_file).parent / '{}.set'.format(Path(tetrode_file).name.split('.')[0])
+        set_header = get_set_header(set_file)
 
-def write_tetrode(tetrode_file, waveform_dict, Fs):
-    ''' Write data to tetrode (`.X`) file
+    # header, data and trailer go through one buffered file handle
+    with open(tetrode_file, 'wb', buffering=1 << 20) as f:
+        write_tetrode_file_header(f, len(spike_samples), Fs, set_header)
+        write_tetrode_file_data(f, spike_samples, waveforms, Fs)
+
+
+def write_tetrode_from_recording(tetrode_file, recording, channel_ids, spike_samples, header, Fs, set_header=None):
+    ''' Cut out waveforms of a tetrode and write them to tetrode (`.X`) file.
+    Runs in a worker process of `write_to_tetrode_files` if there are several
+    tetrodes and `recording` can be serialized.
 
     Parameters
     ----------
     tetrode_file : str or Path
         Full filename of tetrode file to write to
-    waveform_dict : dict
-        Keys are spike timestamps, values are corresponding waveforms (np.memmap).
-        Timestamps are int64, waveforms are int8
+    recording : RecordingExtractor or dict
+        Recording, or its serialized dict (`make_serialized_dict()`), which
+        is re-opened here so the recording does not have to be pickled.
+    channel_ids : List
+        Channel ids of the tetrode
+    spike_samples : np.array
+        Spike samples (n_spikes,) in ascending order, int64
+    header : dict
+        maps parameters from .set file to their values (as strings).
     Fs : int
         Sampling frequency of data
+    set_header : str or None, default=None (optional)
+        First lines of the .set file, as returned by `get_set_header`.
     '''
-    write_tetrode_file_header(tetrode_file, len(waveform_dict), Fs)
-    write_tetrode_file_data(tetrode_file, waveform_dict, Fs)
+    print('Writing', Path(tetrode_file).name)
+
+    if isinstance(recording, dict):
+        recording = se.load_extractor_from_dict(recording)
+
+    waveforms = get_waveforms(recording, channel_ids, spike_samples, header)
+    write_tetrode(tetrode_file, spike_samples, waveforms, Fs, set_header)
 
 
-def write_to_tetrode_files(recording, sorting, group_ids, set_file):
+def write_to_tetrode_files(recording, sorting, group_ids, set_file, max_workers=None):
     '''Get spike samples and waveforms for all tetrodes specified in
     `group_ids`. Note that `group_ids` is 0-indexed, whereas tetrodes are
     1-indexed (so if you want tetrodes 1+2, specify group_ids=[0, 1]).
@@ -251,35 +345,84 @@ def write_to_tetrode_files(recording, sorting, group_ids, set_file):
     ----------
     recording : RecordingExtractor
     sorting : SortingExtractor
-    group_ids : array like
-        Tetrodes to include, but 0-indexed (i.e. tetrodeID - 1)
+    group_ids : array like or None
+        Tetrodes to include, but 0-indexed (i.e. tetrodeID - 1). If None, all
+        tetrodes with units in `sorting` are included.
     set_file : Path or str
         .set file location. Used to determine how many samples prior to and
         post spike sample should be cut out for each waveform. .X files will have
         the same base filename as the .set file. So if you do not want to overwrite
         existing .X files in your .set file directory, copy the .set file to a new
         folder and give its new location. The new .X files will appear there.
+    max_workers : int or None, default=None (optional)
+        Number of worker processes writing tetrode files in parallel. Defaults
+        to the number of tetrodes, capped at 8.
+
+    Notes
+    -----
+    If `recording` can be serialized (`recording.check_if_dumpable()`) and
+    there are several tetrodes, tetrode files are written in separate
+    processes, each re-opening the recording and reading the traces of its
+    own tetrode. Otherwise they are written one after the other in this
+    process. On platforms that spawn new processes (Windows, macOS), scripts
+    calling this function need an `if __name__ == '__main__':` guard.
     '''
 
     assert_group_names_match(sorting, recording)
 
     sampling_rate = recording.get_sampling_frequency()
-    group_ids = get_unit_group_ids(sorting)
+    unit_group_ids = get_unit_group_ids(sorting)
     unit_ids = sorting.get_unit_ids()
     header = parse_generic_header(set_file)
+    set_header = get_set_header(set_file)
 
-    for group_id in np.unique(group_ids):
+    channel_group_ids, channel_offsets, sorted_channel_ids = get_channel_group_index(
+        recording, get_group_property_name(sorting)
+    )
 
-        # get spike samples and waveforms of this group / tetrode
-        group_unit_ids = [unit_ids[i] for i, gid in enumerate(group_ids) if gid == group_id]
-        group_waveforms = get_waveforms(recording, sorting, group_unit_ids, header)
-        group_spike_samples = sorting.get_units_spike_train(unit_ids=group_unit_ids)
+    selected_group_ids = np.unique(unit_group_ids)
+    if group_ids is not None:
+        selected_group_ids = np.intersect1d(selected_group_ids, np.asarray(group_ids, dtype=np.int64))
 
-        # assign each waveform to it's spike sample in a dictionary
-        spike_waveform_dict = combine_units_on_tetrode(group_spike_samples, group_waveforms)
+    tetrodes = []
+    for group_id in selected_group_ids:
 
-        tetrode_filename = str(set_file).split('.')[0] + '.{}'.format(group_id + 1)
-        print('Writing', Path(tetrode_filename).name)
+        # get spike samples and channels of this group / tetrode
+        group_unit_ids = [unit_ids[i] for i in np.flatnonzero(unit_group_ids == group_id)]
+        k = np.searchsorted(channel_group_ids, group_id)
+        assert k < len(channel_group_ids) and channel_group_ids[k] == group_id, \
+            'No channels found for group {}'.format(group_id)
+        group_channel_ids = sorted_channel_ids[channel_offsets[k]:channel_offsets[k + 1]].tolist()
+        spike_samples = combine_units_on_tetrode(sorting.get_units_spike_train(unit_ids=group_unit_ids))
 
-        # write to tetrode file
-        write_tetrode(tetrode_filename, spike_waveform_dict, sampling_rate)
+        tetrode_filename = str(set_file).split('.')[0] + '.{}'.format(group_id + 1)
+        tetrodes.append((tetrode_filename, group_channel_ids, spike_samples))
+
+    if max_workers is None:
+        max_workers = min(8, len(tetrodes))
+
+    # `is_dumpable` of a wrapper (e.g. a bandpass filter) does not tell whether the
+    # wrapped recording can be re-opened, `check_if_dumpable` walks all of them
+    if (max_workers <= 1) or (len(tetrodes) <= 1) or (not recording.check_if_dumpable()):
+        for tetrode_filename, group_channel_ids, spike_samples in tetrodes:
+            write_tetrode_from_recording(
+                tetrode_filename, recording, group_channel_ids, spike_samples, header, sampling_rate, set_header
+            )
+        return
+
+    # dumpable recordings are re-opened in the workers, so reading traces
+    # runs in parallel across tetrodes, too
+    recording_dict = recording.make_serialized_dict()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                write_tetrode_from_recording, tetrode_filename, recording_dict, group_channel_ids,
+                spike_samples, header, sampling_rate, set_header
+            )
+            for tetrode_filename, group_channel_ids, spike_samples in tetrodes
+        ]
+
+        # re-raise errors from the workers
+        for future in futures:
+            future.result()
@@ -1,8 +1,6 @@
-from spikeextractors.extractors.axonaunitrecordingextractor import AxonaUnitRecordingExtractor
-
 from .tint_conversion import (
     write_to_tetrode_files, write_unit_labels_to_file,
-    compare_spike_samples_between_recordings
+    compare_spike_samples_between_files
 )
 from .tint_conversion.utils import assert_group_names_match
 
@@ -56,7 +54,7 @@ class TintConverter():
         self.sorting = sorting
         self.set_file = set_file
 
-    def write_to_tint(self, recording=None, sorting=None, set_file=None):
+    def write_to_tint(self, recording=None, sorting=None, set_file=None, max_workers=None):
         '''Given recording and sorting extractor objects, write appropriate data
         to TINT format (from Axona). Will therefore create .X (tetrode),
         .cut and .clu (spike sorting information) files.
@@ -71,11 +69,20 @@ class TintConverter():
             the same base filename as the .set file. So if you do not want to overwrite
             existing .X files in your .set file directory, copy the .set file to a new
             folder and give its new location. The new files will appear there.
+        max_workers : int or None, default=None (optional)
+            Number of tetrodes written in parallel (in separate processes).
+            Defaults to the number of tetrodes, capped at 8. Use 1 to write
+            all tetrodes in this process.
 
         Notes
         -----
         For details about the .X file format see:
         http://space-memory-navigation.org/DacqUSBFileFormats.pdf
+
+        .X files of several tetrodes are written in separate processes if the
+        recording can be serialized. On platforms that spawn new processes
+        (Windows, macOS), scripts calling this method need an
+        `if __name__ == '__main__':` guard.
         '''
         if (recording is None) and (self.recording is not None):
             recording = self.recording
@@ -93,17 +100,17 @@ class TintConverter():
         assert_group_names_match(self.sorting, self.recording)
 
         # writes to .X files for each tetrode
-        group_ids = recording.get_channel_groups()
-        write_to_tetrode_files(recording, sorting, group_ids, set_file)
+        write_to_tetrode_files(recording, sorting, None, set_file, max_workers=max_workers)
 
         # writes to .cut and .clu files for each tetrode
         write_unit_labels_to_file(sorting, set_file)
 
     def compare_timestamps_after_conversion(self, filename_old, filename_new):
-        ''' Given two AxonaUnitRecordingExtractor objects, one based on .X files
-        created from the raw recording using a thresholding method, and one created
-        from the .X files using a spike sorting algorithm, compute comparison metrics
-        of how well spike times correspond for each tetrode.
+        ''' Given two .set files, one next to .X files created from the raw
+        recording using a thresholding method, and one next to .X files created
+        using a spike sorting algorithm, compute comparison metrics of how well
+        spike times correspond for each tetrode. Only the spike timestamps of
+        the .X files are read.
 
         Parameters
         ----------
@@ -114,9 +121,6 @@ class TintConverter():
         -------
         df : pandas.DataFrame
         '''
-        rec1 = AxonaUnitRecordingExtractor(filename=filename_old, noise_std=0)
-        rec2 = AxonaUnitRecordingExtractor(filename=filename_new, noise_std=0)
-
-        df = compare_spike_samples_between_recordings(rec1, rec2, sorting=self.sorting)
+        df = compare_spike_samples_between_files(filename_old, filename_new, sorting=self.sorting)
 
         return df
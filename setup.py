@@ -27,6 +27,7 @@ setup(
         'click',
         'pillow',
         'scipy',
+        'numba',
         'matplotlib',
         'seaborn',
         'scikit-learn',